@@ -122,7 +122,7 @@ def main():
     term = False
     send_list = None
     regexp = re.compile("Closing file .* seconds, (?P<recs>[0-9]+) records,")
-    closing = re.compile("Stopped logging")
+    closing = "Stopped logging"
     started = re.compile("'.+': Reader thread started")
 
     # Note the time
@@ -178,8 +178,7 @@ def main():
                     started = None
 
             # Check for clean shutdown
-            match = closing.search(line)
-            if match:
+            if closing in line:
                 clean = True
 
             # Check for timeout on SIGTERM shutdown
@@ -15,7 +15,6 @@ from __future__ import print_function
 import optparse
 import subprocess
 import signal
-import re
 import time
 import traceback
 import shutil
@@ -111,8 +110,8 @@ def main():
     term = False
     send_list = None
     limit = len(options.copy) + len(options.move) + options.file_limit
-    regexp = re.compile("APPEND OK")
-    closing = re.compile("Stopped logging")
+    appended = "APPEND OK"
+    closing = "Stopped logging"
 
     if 0 == limit:
         print("ERROR: File limit is zero")
@@ -151,8 +150,7 @@ def main():
                     pass
 
             # Match record counts
-            match = regexp.search(line)
-            if match:
+            if appended in line:
                 count += 1
                 # Reset the timer if we are still receiving data
                 starttime = time.time()
@@ -167,8 +165,7 @@ def main():
                         pass
 
             # Check for clean shutdown
-            match = closing.search(line)
-            if match:
+            if closing in line:
                 clean = True
 
             # Check for timeout on SIGTERM shutdown
@@ -167,8 +167,8 @@ def main():
     term = False
     send_list = None
     regexp = re.compile(": /[^:].*: (?P<recs>[0-9]+) recs")
-    closing = re.compile("Stopped logging")
-    started = re.compile("Starting flush timer")
+    closing = "Stopped logging"
+    started = "Starting flush timer"
 
     # Copy or move data
     copy_files(dirobj, options.copy)
@@ -220,18 +220,15 @@ def main():
                             pass
 
             # check for starting up network data or after-data
-            if started:
-                match = started.search(line)
-                if match:
-                    if send_list is None:
-                        send_list = send_network_data(options)
-                    copy_files(dirobj, options.copy_after)
-                    move_files(dirobj, options.move_after)
-                    started = None
+            if started and started in line:
+                if send_list is None:
+                    send_list = send_network_data(options)
+                copy_files(dirobj, options.copy_after)
+                move_files(dirobj, options.move_after)
+                started = None
 
             # Check for clean shutdown
-            match = closing.search(line)
-            if match:
+            if closing in line:
                 clean = True
 
             # Check for timeout on SIGTERM shutdown
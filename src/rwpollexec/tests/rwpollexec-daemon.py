@@ -29,6 +29,14 @@ from daemon_test import Dirobject, TimedReadline, string_write
 VERBOSE = False
 logfile = None
 
+# Run the daemon in its own process group so os.killpg() reaches any
+# commands it spawns.  start_new_session avoids running Python code
+# in the child between fork() and exec().
+if sys.version_info[0] >= 3:
+    new_pgrp = {"start_new_session": True}
+else:
+    new_pgrp = {"preexec_fn": lambda:os.setpgid(0, 0)}
+
 def base_log(*args):
     global VERBOSE
     global logfile
@@ -181,7 +189,7 @@ def main():
     killed = "Command .* was terminated by SIG"
     complete = re.compile("(?P<success>%s)|(?P<nonzero>%s)|(?P<killed>%s)" %
                           (success, nonzero, killed))
-    closing = re.compile("Stopped logging")
+    closing = "Stopped logging"
 
     if limit == 0:
         parser.print_usage()
@@ -197,8 +205,7 @@ def main():
 
     # Start the process
     log("Running", "'%s'" % "' '".join(args))
-    proc = subprocess.Popen(args, stderr=subprocess.PIPE,
-                            preexec_fn=lambda:os.setpgid(0, 0))
+    proc = subprocess.Popen(args, stderr=subprocess.PIPE, **new_pgrp)
     try:
         os.setpgid(proc.pid, 0)
     except OSError:
@@ -253,8 +260,7 @@ def main():
                         pass
 
             # Check for clean shutdown
-            match = closing.search(line)
-            if match:
+            if closing in line:
                 clean = True
 
             # Check for timeout on SIGTERM shutdown
@@ -14,8 +14,48 @@
 import sys
 import os
 import os.path
+import datetime
 import re
+import shutil
 import subprocess
+import tempfile
+from collections import defaultdict, deque
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+def shell_join(args):
+    return ' '.join(shell_quote(x) for x in args)
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:
+    rsa = None
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+except ImportError:
+    pkcs12 = None
+# Writing a PKCS#12 file needs serialize_key_and_certificates(), and
+# choosing the encryption certtool uses needs the encryption builder
+# (cryptography 38); otherwise fall back to certtool
+if pkcs12 is not None and not (
+        hasattr(pkcs12, "serialize_key_and_certificates")
+        and hasattr(serialization.PrivateFormat, "PKCS12")):
+    pkcs12 = None
 
 top_builddir = os.environ.get('top_builddir')
 if top_builddir:
@@ -28,8 +68,33 @@ if not certtool:
 
 PASSWORD = "x"
 
+# whether to report each command that is run when stderr is not a tty
+verbose = bool(os.environ.get("GENCERTS_VERBOSE"))
+
+# Descriptors are not inherited by default since Python 3.4 (PEP 446),
+# so there is no need to close every descriptor in each child; leaving
+# close_fds off also lets subprocess use posix_spawn() where it can
+close_fds = sys.version_info < (3, 4)
+
 key_bits = 1024
 
+# names of the files in keyloc: a leaf key, a CA certificate (the group
+# is the name of its key), and a PKCS#12 file (the second group is the
+# base name of the CA certificate that signed it)
+_RE_KEY = re.compile(r'key[0-9]+\.pem$')
+_RE_CA_CERT = re.compile(r'ca_cert_(key[0-9]+\.pem)$')
+_RE_P12 = re.compile(r'cert-([^-]+)-(.+)\.p12$')
+
+# matches the output of "certtool --version" for the GnuTLS certtool
+_RE_GNUTLS = re.compile(br"(?i)\b(lib)?gnutls\b")
+
+# Tests take their keys from the pool of keyN.pem files in keyloc and
+# never generate a key unless GENCERTS_BOOTSTRAP is set.  Running this
+# script in a directory without keys creates a pool of key_pool_size
+# keys.
+bootstrap = bool(os.environ.get("GENCERTS_BOOTSTRAP"))
+key_pool_size = 8
+
 tls_template = """
 organization = "test"
 unit = "test"
@@ -57,125 +122,198 @@ pkcs12_key_name = "test"
 password = "%s"
 """ % PASSWORD
 
-r = re.compile(r'key[0-9]+\.pem$')
 srcdir = os.environ.get("srcdir")
 if srcdir is None:
     srcdir = os.path.join(config_vars["abs_srcdir"],
                           "..", "src", "sendrcv")
 keyloc = os.path.join(srcdir, "tests")
-potentials = [os.path.join(keyloc, x) for x in os.listdir(keyloc)
-              if r.match(x)]
-potentials_used = []
-
-r = re.compile(r'ca_cert_(key[0-9]+\.pem)$')
-ca_certs = []
-ca_certs_used = []
-for f in os.listdir(keyloc):
-    match = r.match(f)
+
+# Find the keys, CA certificates, and PKCS#12 files in a single pass
+# over keyloc.  A key used by a CA certificate is not available for
+# use as a leaf key.
+potentials = set()
+ca_keys = set()
+ca_certs = deque()
+ca_certs_used = deque()
+p12_map = defaultdict(list)
+p12s_used = deque()
+if hasattr(os, "scandir"):
+    entries = [(x.name, x.path) for x in os.scandir(keyloc) if x.is_file()]
+else:
+    entries = [(x, os.path.join(keyloc, x)) for x in os.listdir(keyloc)]
+for (name, path) in entries:
+    if _RE_KEY.match(name):
+        potentials.add(path)
+        continue
+    match = _RE_P12.match(name)
     if match:
-        key = os.path.join(keyloc, match.group(1))
-        try:
-            potentials.remove(key)
-        except ValueError:
-            pass
-        ca_certs.append((key, os.path.join(keyloc, f)))
-
-r = re.compile(r'cert-([^-]+)-(.+)\.p12$')
-p12_map = {}
-for f in os.listdir(keyloc):
-    match = r.match(f)
+        p12_map[match.group(2)].append(path)
+        continue
+    match = _RE_CA_CERT.match(name)
     if match:
-        p12 = os.path.join(keyloc, f)
-        ca = match.group(2)
-        if ca in p12_map:
-            p12_map[ca].append(p12)
-        else:
-            p12_map[ca] = [p12]
-p12s_used = []
+        key = os.path.join(keyloc, match.group(1))
+        ca_keys.add(key)
+        ca_certs.append((key, path))
+potentials = deque(sorted(potentials - ca_keys))
+potentials_used = deque()
+
 
+def log_call(args):
+    # Only build the message when someone is likely to read it
+    if verbose or sys.stderr.isatty():
+        sys.stderr.write('Calling "%s"\n' % shell_join(args))
+        sys.stderr.flush()
 
 def check_call(*popenargs, **kwargs):
-    sys.stderr.write('Calling "%s"\n' % ' '.join(*popenargs))
-    sys.stderr.flush()
+    log_call(popenargs[0])
+    kwargs.setdefault('close_fds', close_fds)
     if subprocess.call(*popenargs, **kwargs):
-        raise RuntimeError('Failed to execute "%s"' % ' '.join(*popenargs))
+        raise RuntimeError('Failed to execute "%s"' % shell_join(popenargs[0]))
+
 
+# set once certtool has been verified to be the GnuTLS version; the
+# check runs at most once per process
+certtool_checked = False
 
 def check_certtool():
-    sys.stderr.write('Calling "%s --version"\n' % certtool)
-    sys.stderr.flush()
-    proc = subprocess.Popen([certtool, '--version'], close_fds=True,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output = proc.stdout.read()
-    if not re.search(br"(?i)\b(lib)?gnutls\b", output):
+    global certtool_checked
+    if certtool_checked:
+        return
+    log_call([certtool, '--version'])
+    devnull = open(os.devnull, "wb")
+    try:
+        proc = subprocess.Popen([certtool, '--version'], close_fds=close_fds,
+                                stdout=subprocess.PIPE, stderr=devnull)
+        output = proc.communicate()[0]
+    finally:
+        devnull.close()
+    if not _RE_GNUTLS.search(output):
         raise RuntimeError(
             "Found %s program but it not associated with GnuTLS" % certtool)
+    certtool_checked = True
 
 
 def create_certs(tmpdir):
+    # Without leaf keys there is nothing to sign, so do not create a
+    # CA.  The CA is still created before any leaf key is taken since
+    # a new CA takes its key from the same pool.
+    if not potentials:
+        return
     ca_cert_pair = generate_ca_cert(tmpdir, "ca_cert.pem")
     newname = "ca_cert_" + os.path.basename(ca_cert_pair[0])
     sys.stderr.write('mv "%s" "%s"\n' % (ca_cert_pair[1], newname))
     sys.stderr.flush()
     os.rename(ca_cert_pair[1], newname)
     ca_cert_pair = (ca_cert_pair[0], newname)
+    ca_base = os.path.splitext(os.path.basename(ca_cert_pair[1]))[0]
+    # Gather the certificates that must be signed, then sign them in
+    # parallel since each one is independent
+    jobs = []
     key = get_key()
     while key:
         key_base = os.path.splitext(os.path.basename(key))[0]
-        ca_base = os.path.splitext(os.path.basename(ca_cert_pair[1]))[0]
         newname = "cert-" + key_base + "-" + ca_base + ".p12"
-        generate_signed_cert(tmpdir, ca_cert_pair, key, newname)
+        if not get_p12(ca_cert_pair[1]):
+            jobs.append((tmpdir, ca_cert_pair, key, newname))
         key = get_key()
+    if jobs:
+        if pkcs12 is None:
+            # write the templates once before the jobs start
+            check_certtool()
+            template_path(tmpdir, "prog_template", tls_prog_template)
+            template_path(tmpdir, "template12", tls_p12_template)
+        map_jobs(sign_job, jobs)
+
+def map_jobs(fn, jobs):
+    if ProcessPoolExecutor is None or len(jobs) < 2:
+        return [fn(x) for x in jobs]
+    with ProcessPoolExecutor() as executor:
+        return list(executor.map(fn, jobs))
+
+def sign_job(job):
+    return create_signed_cert(*job)
+
+def take_from_pool(pool, used):
+    # Remove an item from 'pool', remember it in 'used', and return
+    # it.  Return None when 'pool' is empty.
+    if pool:
+        item = pool.pop()
+        used.append(item)
+        return item
+    return None
+
+def restore_pool(pool, used):
+    # Return every item taken from 'pool' since the last restore
+    pool.extend(used)
+    used.clear()
 
 def reset_used_keys():
-    global potentials
-    global potentials_used
-    potentials.extend(potentials_used)
-    used = []
+    restore_pool(potentials, potentials_used)
 
 def get_key():
-    global potentials
-    global potentials_used
-    if potentials:
-        key = potentials.pop()
-        potentials_used.append(key)
-        return key
-    return None
-
-def generate_key(filename):
-    name = get_key()
-    if not name:
-        name = filename
+    return take_from_pool(potentials, potentials_used)
+
+def new_key(filename):
+    # Generate the key in-process when the cryptography package is
+    # available; otherwise run certtool
+    if rsa is not None:
+        key = rsa.generate_private_key(public_exponent=65537,
+                                       key_size=key_bits,
+                                       backend=default_backend())
+        pem = key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.TraditionalOpenSSL,
+                                serialization.NoEncryption())
+        key_file = open(filename, "wb")
+        key_file.write(pem)
+        key_file.close()
+    else:
         check_certtool()
         check_call(
             [certtool, '--generate-privkey', '--outfile', filename,
              '--bits', str(key_bits)])
+    return filename
+
+def generate_key(filename):
+    name = get_key()
+    if not name:
+        if not bootstrap:
+            raise RuntimeError("Key pool is exhausted; set GENCERTS_BOOTSTRAP"
+                               " to generate new keys")
+        name = new_key(filename)
     return name
 
 def get_ca_cert():
-    global ca_certs
-    global ca_certs_used
-    if ca_certs:
-        cert = ca_certs.pop()
-        ca_certs_used.append(cert)
-        return cert
+    return take_from_pool(ca_certs, ca_certs_used)
 
 def reset_ca_certs():
-    global ca_certs
-    global ca_certs_used
-    ca_certs.extend(ca_certs_used)
-    ca_certs_used = []
-
+    restore_pool(ca_certs, ca_certs_used)
+
+
+templates_written = {}
+
+def template_path(tmpdir, name, contents):
+    # Return the path to the certtool template file 'name' in
+    # 'tmpdir', writing it only the first time it is requested.  The
+    # file is written under a temporary name and renamed so that
+    # concurrent jobs never read a partial template.
+    path = os.path.join(tmpdir, name)
+    if path in templates_written:
+        return path
+    (fd, tmp) = tempfile.mkstemp(prefix=name, dir=tmpdir)
+    template_file = os.fdopen(fd, "w")
+    template_file.write(contents)
+    template_file.close()
+    os.rename(tmp, path)
+    templates_written[path] = True
+    return path
 
 def create_self_signed_ca_cert(tmpdir, key, filename):
-    template = os.path.join(tmpdir, "ca_template")
-    template_file = open(template, "w")
-    template_file.write(tls_ca_template)
-    template_file.close()
+    template = template_path(tmpdir, "ca_template", tls_ca_template)
     check_certtool()
     check_call(
         [certtool, '--generate-self-signed', '--template',
          template, '--load-privkey', key, '--outfile', filename])
+    return filename
 
 def generate_ca_cert(tmpdir, filename):
     ca_cert = get_ca_cert()
@@ -186,58 +324,146 @@ def generate_ca_cert(tmpdir, filename):
     return ca_cert
 
 
+def load_file(path):
+    f = open(path, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def authority_key_id(ca_cert, ca_key):
+    # Use the CA certificate's own subject key identifier; certtool
+    # does not compute it the way from_issuer_public_key() does, and a
+    # mismatch keeps the leaf from verifying against the CA
+    try:
+        ski = ca_cert.extensions.get_extension_for_class(
+            x509.SubjectKeyIdentifier).value
+    except x509.ExtensionNotFound:
+        return x509.AuthorityKeyIdentifier.from_issuer_public_key(
+            ca_key.public_key())
+    return x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski)
+
+def sign_and_pack(ca_cert_pair, key, filename):
+    # Create a certificate for 'key' signed by the CA and write it
+    # with the key to the PKCS#12 file 'filename'.  This produces the
+    # same result as the certtool commands in create_signed_cert()
+    # using tls_prog_template and tls_p12_template, without any
+    # intermediate files.
+    (ca_key, ca_cert) = ca_cert_pair
+    backend = default_backend()
+    ca_key = serialization.load_pem_private_key(
+        load_file(ca_key), password=None, backend=backend)
+    ca_cert = x509.load_pem_x509_certificate(load_file(ca_cert), backend)
+    key = serialization.load_pem_private_key(
+        load_file(key), password=None, backend=backend)
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, u"test"),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, u"test"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, u"test"),
+        x509.NameAttribute(NameOID.COUNTRY_NAME, u"US"),
+        x509.NameAttribute(NameOID.COMMON_NAME, u"test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = x509.CertificateBuilder(
+    ).subject_name(subject
+    ).issuer_name(ca_cert.subject
+    ).public_key(key.public_key()
+    ).serial_number(1
+    ).not_valid_before(now
+    ).not_valid_after(now + datetime.timedelta(days=18300)
+    ).add_extension(x509.BasicConstraints(ca=False, path_length=None),
+                    critical=True
+    ).add_extension(x509.KeyUsage(digital_signature=True,
+                                  content_commitment=False,
+                                  key_encipherment=True,
+                                  data_encipherment=False,
+                                  key_agreement=False,
+                                  key_cert_sign=False,
+                                  crl_sign=False,
+                                  encipher_only=False,
+                                  decipher_only=False),
+                    critical=True
+    ).add_extension(x509.SubjectKeyIdentifier.from_public_key(
+                        key.public_key()),
+                    critical=False
+    ).add_extension(authority_key_id(ca_cert, ca_key),
+                    critical=False)
+    cert = builder.sign(ca_key, hashes.SHA256(), backend)
+    # encrypt as certtool --to-p12 does (the checked-in files use
+    # 3DES with a SHA-1 MAC), which GnuTLS is known to load
+    encryption = (serialization.PrivateFormat.PKCS12.encryption_builder()
+                  .key_cert_algorithm(
+                      pkcs12.PBES.PBESv1SHA1And3KeyTripleDESCBC)
+                  .hmac_hash(hashes.SHA1())
+                  .build(PASSWORD.encode('ascii')))
+    p12 = pkcs12.serialize_key_and_certificates(
+        b"test", key, cert, None, encryption)
+    p12_file = open(filename, "wb")
+    p12_file.write(p12)
+    p12_file.close()
+
 def create_signed_cert(tmpdir, ca_cert_pair, key, filename):
+    # The templates are shared by all calls using 'tmpdir'; the
+    # intermediate request and certificate are written to a private
+    # directory so that concurrent calls do not collide
+    if pkcs12 is not None:
+        sign_and_pack(ca_cert_pair, key, filename)
+        return filename
     (ca_key, ca_cert) = ca_cert_pair
-    template = os.path.join(tmpdir, "prog_template")
-    template_file = open(template, "w")
-    template_file.write(tls_prog_template)
-    template_file.close()
-    template12 = os.path.join(tmpdir, "template12")
-    template12_file = open(template12, "w")
-    template12_file.write(tls_p12_template)
-    template12_file.close()
+    template = template_path(tmpdir, "prog_template", tls_prog_template)
+    template12 = template_path(tmpdir, "template12", tls_p12_template)
     check_certtool()
-    check_call(
-        [certtool, '--generate-request', '--load-privkey', key,
-         '--outfile', os.path.join(tmpdir, 'request.pem'),
-         '--template', template])
-    check_call(
-        [certtool, '--generate-certificate',
-         '--load-request', os.path.join(tmpdir, 'request.pem'),
-         '--outfile', os.path.join(tmpdir, 'cert.pem'),
-         '--template', template,
-         '--load-ca-certificate', ca_cert,
-         '--load-ca-privkey', ca_key])
-    check_call(
-        [certtool,
-         '--load-certificate', os.path.join(tmpdir, 'cert.pem'),
-         '--load-privkey', key,
-         '--to-p12', '--outder', '--template', template12,
-         '--outfile', filename])
+    workdir = tempfile.mkdtemp(prefix="silk_cert_", dir=tmpdir)
+    try:
+        request = os.path.join(workdir, 'request.pem')
+        cert = os.path.join(workdir, 'cert.pem')
+        check_call(
+            [certtool, '--generate-request', '--load-privkey', key,
+             '--outfile', request,
+             '--template', template])
+        check_call(
+            [certtool, '--generate-certificate',
+             '--load-request', request,
+             '--outfile', cert,
+             '--template', template,
+             '--load-ca-certificate', ca_cert,
+             '--load-ca-privkey', ca_key])
+        check_call(
+            [certtool,
+             '--load-certificate', cert,
+             '--load-privkey', key,
+             '--to-p12', '--outder', '--template', template12,
+             '--outfile', filename])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return filename
 
-def generate_signed_cert(tmpdir, ca_cert_pair, key, filename):
-    global p12_map
-    global p12s_used
-    (ca_key, ca_cert) = ca_cert_pair
+def get_p12(ca_cert):
     basecert = os.path.splitext(os.path.basename(ca_cert))[0]
-    if basecert in p12_map:
-        plist = p12_map[basecert]
+    plist = p12_map.get(basecert)
+    if plist:
         p12 = plist.pop()
         p12s_used.append((basecert, p12))
         return p12
+    return None
+
+def generate_signed_cert(tmpdir, ca_cert_pair, key, filename):
+    p12 = get_p12(ca_cert_pair[1])
+    if p12:
+        return p12
     if not os.path.exists(key):
         key = generate_key(key)
-    create_signed_cert(tmpdir, ca_cert_pair, key, filename)
-    return filename
+    return create_signed_cert(tmpdir, ca_cert_pair, key, filename)
 
 def reset_used_certs():
-    global p12_map
-    global p12s_used
     for key, value in p12s_used:
         p12_map[key].append(value)
-    p12s_used = []
+    p12s_used.clear()
 
 def reset_all_certs_and_keys():
+    # Return every key, CA certificate, and PKCS#12 file handed out
+    # since the last reset to its pool.  Nothing is generated here:
+    # tests draw on the files already in keyloc, and only an exhausted
+    # pool causes new material to be created.
     reset_used_keys()
     reset_ca_certs()
     reset_used_certs()
@@ -321,7 +547,9 @@ def reset_all_certs_and_keys():
 
 if __name__ == '__main__':
     if not potentials:
-        for i in range(1,9):
-            generate_key("key%s.pem" % i)
+        if rsa is None:
+            check_certtool()
+        map_jobs(new_key,
+                 ["key%s.pem" % i for i in range(1, key_pool_size + 1)])
     else:
         create_certs("/tmp")
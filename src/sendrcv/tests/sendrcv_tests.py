@@ -18,23 +18,32 @@ import os
 import os.path
 import tempfile
 import random
-import stat
+import errno
 import fcntl
 import re
 import shutil
 import itertools
+import contextlib
+import functools
 import optparse
 import time
 import signal
 import select
 import subprocess
 import socket
-import json
 import traceback
 import struct
 import datetime
 
-conv = json
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    import cPickle as conv
+except ImportError:
+    import pickle as conv
 
 srcdir = os.environ.get("srcdir")
 if srcdir:
@@ -49,18 +58,32 @@ os.environ["RWRECEIVER_TLS_PASSWORD"] = PASSWORD
 try:
     import hashlib
     md5_new = hashlib.md5
-    sha1_new = hashlib.sha1
+    # Python 3.11+
+    file_digest = getattr(hashlib, "file_digest", None)
 except ImportError:
     import md5
     md5_new = md5.new
-    import sha
-    sha1_new = sha.new
+    file_digest = None
+
+# the random files only need to survive the transfer intact, so use
+# NumPy's faster non-cryptographic generator when it is available
+try:
+    import numpy
+    random_bytes = numpy.random.default_rng().bytes
+except (ImportError, AttributeError):
+    random_bytes = os.urandom
 
 
 global_int     = 0
 
 KILL_DELAY     = 20
-CHUNKSIZE      = 2048
+# maximum number of bytes of application output taken per read
+LOG_READSIZE   = 65536
+CHUNKSIZE      = 1 << 20
+# random files up to this size are generated with a single write;
+# larger ones in RANDOM_CHUNK pieces
+RANDOM_SINGLE  = 1 << 26
+RANDOM_CHUNK   = 1 << 24
 OVERWRITE      = False
 LOG_LEVEL      = "info"
 LOG_OUTPUT     = []
@@ -89,14 +112,25 @@ ALL_TESTS = ['testConnectOnlyIPv4Addr', 'testConnectOnlyHostname',
              'testFilter', 'testPostCommand']
 
 rfiles = None
+# regexp-escaped basenames of the files in rfiles, keyed by path
+escaped_names = {}
 
 TIMEOUT_FACTOR = 1.0
 
 
+# Python 2/3 differences, resolved once.  to_text() decodes the
+# applications' output, which is ASCII; Python 2 keeps it as a byte
+# string.
 if sys.version_info[0] >= 3:
-    coding = {"encoding": "ascii"}
+    def to_text(data):
+        return data.decode("ascii")
+    zip_longest = itertools.zip_longest
 else:
-    coding = {}
+    to_text = str
+    zip_longest = itertools.izip_longest
+
+# whether Popen.wait() accepts a timeout (Python 3.3+)
+wait_timeout = hasattr(subprocess, "TimeoutExpired")
 
 
 class TriggerError(Exception):
@@ -129,31 +163,60 @@ def setup():
     for line in file_list:
         (path, size, md5) = line.split()
         path = os.path.join(top_tests, path)
-        # empty string is placeholder for SHA1 digest
-        rfiles.append((path, (int(size), "", md5)))
+        rfiles.append((path, (int(size), md5)))
+        escaped_names[path] = re.escape(os.path.basename(path))
 
 def teardown():
     pass
 
+# the build's features do not change during a run
+TLS_SUPPORTED  = bool(int(config_vars.get('SK_ENABLE_GNUTLS', '0')))
+IPV6_SUPPORTED = bool(int(config_vars.get('SK_ENABLE_INET6_NETWORKING',
+                                          '0')))
+
 def tls_supported():
-    return eval(config_vars.get('SK_ENABLE_GNUTLS', None))
+    return TLS_SUPPORTED
 
 def ipv6_supported():
-    return eval(config_vars.get('SK_ENABLE_INET6_NETWORKING', None))
+    return IPV6_SUPPORTED
 
 trigger_id = 0
 
+# compiled trigger regexps, keyed by (pid, match); pid is None for
+# triggers that are not restricted to the application's own messages
+trigger_patterns = {}
+
+def compile_trigger(pid, match):
+    key = (pid, match)
+    regexp = trigger_patterns.get(key)
+    if regexp is None:
+        if pid is None:
+            regexp = re.compile(match)
+        else:
+            regexp = re.compile(r"\[%s\].*%s" % (pid, match))
+        trigger_patterns[key] = regexp
+    return regexp
+
 def trigger(*specs, **kwd):
+    # Each spec is (daemon, timeout, match).  All the daemons get
+    # their trigger before any reply is read, and the replies are
+    # collected with one select() loop, so the waits run in parallel
+    # and take as long as the slowest one.  With first=True, return
+    # once any of them fires.
     global trigger_id
     trigger_id += 1
     pid = kwd.get('pid', True)
     first = kwd.get('first', False)
+    matches = kwd.get('matches', 1)
     pipes = {}
     count = len(specs)
     retval = []
     for daemon, timeout, match in specs:
+        # accept compiled regexps; the daemon compiles (and caches)
+        # the pattern text itself
+        match = getattr(match, "pattern", match)
         daemon.dump(('trigger',
-                     {'pid': pid, 'id': trigger_id,
+                     {'pid': pid, 'id': trigger_id, 'matches': matches,
                       'match': match, 'timeout': t(timeout)}))
         pipes[daemon.pipe] = (daemon, timeout, match, len(retval))
         retval.append(None)
@@ -179,77 +242,119 @@ def trigger(*specs, **kwd):
                 return retval
     return retval
 
+def trigger_names(daemon, timeout, match, names, **kwd):
+    # Wait for 'daemon' to log 'match' once for each of 'names', which
+    # are regexps.  'match' must contain "%s", which is replaced by a
+    # group that matches any of the names; 'timeout' is per name.
+    # With no names there is nothing to wait for.
+    if not names:
+        return []
+    pattern = match % ("(" + "|".join(names) + ")")
+    return trigger((daemon, timeout * len(names), pattern),
+                   matches=len(names), **kwd)
+
+# log messages watched for by check_started()
+ATTEMPT_TLS = r"Attempting to connect to \S+ \(TCP, TLS\)"
+ATTEMPT_TCP = r"Attempting to connect to \S+ \(TCP\)"
+BOUND_TLS   = r"Bound to \S+ for listening \(TCP, TLS\)"
+BOUND_TCP   = r"Bound to \S+ for listening \(TCP\)"
+
 def check_started(clients, servers, tls):
     if tls:
-        tcp_tls = r"\(TCP, TLS\)"
+        attempt = ATTEMPT_TLS
+        bound = BOUND_TLS
         timeout = 120
     else:
-        tcp_tls = r"\(TCP\)"
+        attempt = ATTEMPT_TCP
+        bound = BOUND_TCP
         timeout = 10
-    watches = itertools.chain(
-        ((c, timeout, r"Attempting to connect to \S+ %s" % tcp_tls)
-         for c in clients),
-        ((s, timeout, r"Bound to \S+ for listening %s" % tcp_tls)
-         for s in servers))
+    watches = ([(c, timeout, attempt) for c in clients]
+               + [(s, timeout, bound) for s in servers])
     trigger(*watches)
 
 def check_connected(clients, servers, timeout=25):
-    if sys.version_info[0] < 3:
-        zipper = itertools.izip_longest
-    else:
-        zipper = itertools.zip_longest
-    for c,s in zipper(clients, servers):
+    connected = dict((d, "Connected to remote " + re.escape(d.name))
+                     for d in itertools.chain(clients, servers))
+    for c,s in zip_longest(clients, servers):
         watches = []
         if c is not None:
-            watches = watches + [
-                (s, timeout, "Connected to remote %s" % c.name) for s in servers
-            ]
+            watches.extend((srv, timeout, connected[c]) for srv in servers)
         if s is not None:
-            watches = watches + [
-                (c, timeout, "Connected to remote %s" % s.name) for c in clients
-            ]
+            watches.extend((cli, timeout, connected[s]) for cli in clients)
         trigger(*watches)
 
 def create_random_file(suffix="", prefix="random", dir=None, size=(0, 0)):
     (handle, path) = tempfile.mkstemp(suffix, prefix, dir)
-    f = os.fdopen(handle, "w")
     numbytes = random.randint(size[0], size[1])
     totalbytes = numbytes
-    #checksum_sha = sha1_new()
     checksum_md5 = md5_new()
+    if numbytes <= RANDOM_SINGLE:
+        chunk = numbytes
+    else:
+        chunk = RANDOM_CHUNK
     while numbytes:
-        length = min(numbytes, CHUNKSIZE)
-        try:
-            bytes = os.urandom(length)
-        except NotImplementedError:
-            bytes = ''.join(chr(random.getrandbits(8))
-                            for x in range(0, length))
-        f.write(bytes)
-        #checksum_sha.update(bytes)
-        checksum_md5.update(bytes)
+        length = min(numbytes, chunk)
+        data = random_bytes(length)
+        written = os.write(handle, data)
+        while written < length:
+            written += os.write(handle, data[written:])
+        checksum_md5.update(data)
         numbytes -= length
-    f.close()
-    # empty string is placeholder for SHA1 digest
-    return (path, (totalbytes, "", checksum_md5.hexdigest()))
+    os.close(handle)
+    return (path, (totalbytes, checksum_md5.hexdigest()))
 
-def checksum_file(path):
-    f = open(path, 'rb')
-    #checksum_sha = sha1_new()
-    checksum_md5 = md5_new()
-    size = os.fstat(f.fileno())[stat.ST_SIZE]
-    data = f.read(CHUNKSIZE)
-    while data:
-        #checksum_sha.update(data)
-        checksum_md5.update(data)
-        data = f.read(CHUNKSIZE)
+def checksum_only(path):
+    f = open(path, 'rb', 0)
+    if file_digest:
+        checksum_md5 = file_digest(f, "md5")
+    else:
+        checksum_md5 = md5_new()
+        buf = bytearray(CHUNKSIZE)
+        view = memoryview(buf)
+        n = f.readinto(buf)
+        while n:
+            checksum_md5.update(view[:n])
+            n = f.readinto(buf)
     f.close()
-    # empty string is placeholder for SHA1 digest
-    return (size, "", checksum_md5.hexdigest())
+    return checksum_md5.hexdigest()
 
 
-sconv = "L"
-slen  = struct.calcsize(sconv)
+# length prefix of each message on a stream socket
+msg_header = struct.Struct("<I")
 
+# largest message sent on a packet socket; the socket buffers are
+# sized to hold it
+MSG_MAX = 65536
+
+# errors from sending to a peer that has gone away
+PEER_GONE = frozenset([errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN])
+
+def ipc_socketpair():
+    # return a connected pair of sockets and whether they keep message
+    # boundaries.  SOCK_SEQPACKET does, so its messages need no length
+    # prefix, but not every platform supports it for AF_UNIX
+    try:
+        pipes = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    except (AttributeError, socket.error):
+        return (socket.socketpair(), False)
+    for sock in pipes:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * MSG_MAX)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * MSG_MAX)
+    return (pipes, True)
+
+# Messages between a Daemon and its child process are pickled, except
+# for trigger replies, which are the bulk of the traffic: those are a
+# tag byte, the trigger id, a success flag, and the matching line.
+# Pickles always start with the PROTO opcode, so the tag is
+# unambiguous.
+TRIGGER_TAG   = b"T"
+trigger_reply = struct.Struct("!cI?")
+
+
+# Each Daemon is managed by a process forked in start().  That process
+# reads the program's log once, line by line, and checks each line
+# against the pending trigger, so every trigger() sent to a daemon is
+# served from the one reader.
 
 class Daemon(Dirobject):
 
@@ -264,16 +369,22 @@ class Daemon(Dirobject):
             global_int += 1
         self.process = None
         self.logdata = []
+        # maps a trigger regexp to (number of lines of logdata when last
+        # searched, first matching line or None)
+        self.scanned = {}
         self.log_level = log_level
         self._prog_env = prog_env
         self.daemon = True
         self.verbose = verbose
         self.pipe = None
+        self.packet = False
         self.pid = None
         self.trigger = None
         self.timeout = None
         self.channels = []
-        self.pending_line = None
+        self.poller = None
+        self.pending_line = bytearray()
+        self._args = None
 
     def printv(self, *args):
         if self.pid is None or self.pid != 0:
@@ -303,39 +414,69 @@ class Daemon(Dirobject):
             global_log(self.name, msg)
 
     def _handle_log(self, fd):
-        # 'fd' is the log of the process, which supports non-blocking
-        # reads.  read from the log until there is thing left to read,
-        # so that select() on 'fd' will work correctly
-        got_line = False
+        # 'fd' is the log of the process, which is non-blocking.  take
+        # whatever is available with a single read of the descriptor,
+        # holding on to a trailing partial line until the next call.
+        # return False when nothing was read (end of file or no data)
         try:
-            # when no-more-data, following returns empty string in
-            # Python3, but throws IOError [EAGAIN] in Python2
-            for line in fd:
-                line = str(line, **coding)
-                # handle reading a partial line last time and this time
-                if self.pending_line:
-                    line = self.pending_line + line
-                    self.pending_line = None
-                if line[-1] != "\n":
-                    self.pending_line = line
-                    break
-                got_line = True
-                self.logdata.append(line)
-                global_log(self.name, line, timestamp=False)
-                if self.trigger:
-                    match = self.trigger['re'].search(line)
-                    if match:
-                        self.log_verbose(
-                            'Trigger fired for "%s"' % self.trigger['match'])
-                        self.dump(('trigger', self.trigger['id'], True, line))
-                        self.timeout = None
-                        self.trigger = None
-        except IOError:
-            pass
-        if not got_line:
+            data = os.read(fd.fileno(), LOG_READSIZE)
+        except OSError:
+            return False
+        if not data:
             return False
+        # every line is echoed by global_log(), so decode all the
+        # complete lines at once rather than one at a time
+        self.pending_line.extend(data)
+        end = self.pending_line.rfind(b"\n") + 1
+        if not end:
+            return True
+        text = to_text(self.pending_line[:end])
+        del self.pending_line[:end]
+        lines = text.split("\n")
+        lines.pop()
+        for line in lines:
+            line += "\n"
+            self.logdata.append(line)
+            global_log(self.name, line, timestamp=False)
+            if self.trigger:
+                match = self.trigger['re'].search(line)
+                if 'seen' in self.trigger:
+                    fired = match is not None and self._count_match(match)
+                else:
+                    fired = match is not None
+                    self.scanned[self.trigger['re']] = (len(self.logdata),
+                                                        fired and line or None)
+                if fired:
+                    self.log_verbose(
+                        'Trigger fired for "%s"' % self.trigger['match'])
+                    self.dump(('trigger', self.trigger['id'], True, line))
+                    self.timeout = None
+                    self.trigger = None
         return True
 
+    def _count_match(self, match):
+        # for a trigger waiting on several different matches, note the
+        # value of the first group (or the whole match) and return True
+        # once enough different values have been seen
+        seen = self.trigger['seen']
+        seen.add(match.group(1 if match.re.groups else 0))
+        return len(seen) >= self.trigger['matches']
+
+    def _search_log(self, regexp):
+        # return the first line of the captured output that matches
+        # 'regexp', or None
+        (scanned, line) = self.scanned.get(regexp, (0, None))
+        if line is None:
+            # only look at the lines added since this regexp last
+            # searched the output
+            for line in itertools.islice(self.logdata, scanned, None):
+                if regexp.search(line):
+                    break
+            else:
+                line = None
+        self.scanned[regexp] = (len(self.logdata), line)
+        return line
+
     def _handle_parent(self):
         retval = False
         request = self.load()
@@ -363,38 +504,57 @@ class Daemon(Dirobject):
             # search previously captured output from the application
             self.trigger = request[1]
             if self.trigger['pid']:
-                regexp = re.compile(r"\[%s\].*%s" %
-                                    (self.process.pid, self.trigger['match']))
+                regexp = compile_trigger(self.process.pid,
+                                         self.trigger['match'])
             else:
-                regexp = re.compile(self.trigger['match'])
-            for line in self.logdata:
-                match = regexp.search(line)
-                if match:
-                    self.log_verbose(
-                        'Trigger fired for "%s"' % self.trigger['match'])
-                    self.dump(('trigger', self.trigger['id'], True, line))
-                    self.trigger = None
-                    return retval
+                regexp = compile_trigger(None, self.trigger['match'])
+            if self.trigger['matches'] > 1:
+                # any line logged so far may hold some of the matches
+                self.trigger['seen'] = set()
+                for line in self.logdata:
+                    match = regexp.search(line)
+                    if match and self._count_match(match):
+                        break
+                else:
+                    line = None
+            else:
+                line = self._search_log(regexp)
+            if line is not None:
+                self.log_verbose(
+                    'Trigger fired for "%s"' % self.trigger['match'])
+                self.dump(('trigger', self.trigger['id'], True, line))
+                self.trigger = None
+                return retval
             self.trigger['re'] = regexp
             self.timeout = time.time() + self.trigger['timeout']
         return retval
 
+    def _add_channel(self, channel):
+        self.channels.append(channel)
+        self.poller.register(channel, select.POLLIN)
+
+    def _remove_channel(self, channel):
+        self.channels.remove(channel)
+        self.poller.unregister(channel)
+
     def _child(self):
         while self.channels:
             # channels contains a socket to the parent and to the
-            # stderr of the application's process
-            (readers, writers, x) = select.select(self.channels, [], [], 1)
-            if self.process is not None and self.process.stderr in readers:
+            # stderr of the application's process, each of which is
+            # registered with the poller
+            readers = set(fd for (fd, event) in self.poller.poll(1000))
+            if (self.process is not None
+                and self.process.stderr.fileno() in readers):
                 rv = self._handle_log(self.process.stderr)
                 if not rv:
-                    self.channels.remove(self.process.stderr)
-            if self.pipe in readers:
+                    self._remove_channel(self.process.stderr)
+            if self.pipe.fileno() in readers:
                 if self._handle_parent():
+                    self._remove_channel(self.pipe)
                     try:
                         self.pipe.close()
                     except:
                         pass
-                    self.channels.remove(self.pipe)
             if self.timeout is not None and time.time() > self.timeout:
                 self.log_verbose(
                     'Trigger timed out after %s seconds: "%s"' %
@@ -421,7 +581,7 @@ class Daemon(Dirobject):
             self.dump(('start',))
             self.expect('start')
             return None
-        pipes = socket.socketpair()
+        (pipes, self.packet) = ipc_socketpair()
         self.pid = os.fork()
         if self.pid != 0:
             pipes[1].close()
@@ -432,7 +592,8 @@ class Daemon(Dirobject):
         try:
             pipes[0].close()
             self.pipe = pipes[1]
-            self.channels = [self.pipe]
+            self.poller = select.poll()
+            self._add_channel(self.pipe)
             self._child()
         except:
             traceback.print_exc()
@@ -446,36 +607,79 @@ class Daemon(Dirobject):
 
     def _start(self):
         if self.process is not None and self.process.stderr in self.channels:
-            self.channels.remove(self.process.stderr)
-        # work around issue #11459 in python 3.1.[0-3], 3.2.0 (where a
-        # process is line buffered despite bufsize=0) by making the
-        # buffer large, making the stream non-blocking, and getting
-        # everything available from the stream when we read
-        self.process = subprocess.Popen(self.get_args(), bufsize = -1,
+            self._remove_channel(self.process.stderr)
+        # the log is read directly from the descriptor by
+        # _handle_log(), so make it non-blocking
+        # the application is only run by the child, whose copy of the
+        # configuration is fixed once it has forked; build the command
+        # line once for all restarts
+        if self._args is None:
+            self._args = list(self.get_args())
+        self.process = subprocess.Popen(self._args, bufsize = -1,
                                         stderr=subprocess.PIPE)
         fcntl.fcntl(self.process.stderr, fcntl.F_SETFL,
                     (os.O_NONBLOCK
                      | fcntl.fcntl(self.process.stderr, fcntl.F_GETFL)))
-        self.channels.append(self.process.stderr)
+        self._add_channel(self.process.stderr)
         self.dump(('start',))
 
     def dump(self, arg):
-        value = conv.dumps(arg).encode('ascii')
-        data = struct.pack(sconv, len(value)) + value
+        if arg[0] == 'trigger' and not isinstance(arg[1], dict):
+            value = trigger_reply.pack(TRIGGER_TAG, arg[1], arg[2])
+            if arg[2]:
+                value += arg[3].encode("ascii")
+            # the matching line is only informative; cut a very long
+            # one short rather than fail
+            value = value[:MSG_MAX]
+        else:
+            value = conv.dumps(arg, conv.HIGHEST_PROTOCOL)
+        if self.packet and len(value) > MSG_MAX:
+            raise ValueError("Message of %d bytes is larger than %d"
+                             % (len(value), MSG_MAX))
         try:
-            self.pipe.sendall(data)
-        except IOError:
-            pass
+            if self.packet:
+                self.pipe.send(value)
+            else:
+                self.pipe.sendall(msg_header.pack(len(value)) + value)
+        except (IOError, OSError) as err:
+            # only ignore the other side having exited
+            if err.errno not in PEER_GONE:
+                raise
+
+    def _recv(self):
+        if self.packet:
+            # ask for one byte more than any message so that a
+            # truncated message is noticed
+            value = self.pipe.recv(MSG_MAX + 1)
+            if not value:
+                raise RuntimeError
+            if len(value) > MSG_MAX:
+                raise RuntimeError("Message larger than %d bytes" % MSG_MAX)
+            return value
+        rv = self.pipe.recv(msg_header.size, socket.MSG_WAITALL)
+        if len(rv) != msg_header.size:
+            raise RuntimeError
+        (length,) = msg_header.unpack(rv)
+        value = bytearray(length)
+        view = memoryview(value)
+        got = 0
+        while got < length:
+            n = self.pipe.recv_into(view[got:], length - got,
+                                    socket.MSG_WAITALL)
+            if not n:
+                raise RuntimeError
+            got += n
+        return value
 
     def load(self):
-        rv = self.pipe.recv(slen)
-        if len(rv) != slen:
-            raise RuntimeError
-        (length,) = struct.unpack(sconv, rv)
-        value = b""
-        while len(value) != length:
-            value += self.pipe.recv(length)
-        retval = conv.loads(value.decode('ascii'))
+        value = self._recv()
+        if value[:1] == TRIGGER_TAG:
+            (tag, id, ok) = trigger_reply.unpack_from(value)
+            if ok:
+                line = to_text(value[trigger_reply.size:])
+                return ('trigger', id, True, line)
+            return ('trigger', id, False)
+        retval = conv.loads(bytes(value))
         return retval
 
     def kill(self):
@@ -530,21 +734,32 @@ class Daemon(Dirobject):
                 pass
         self.dump(('stop',))
 
-    def _end(self):
-        target = time.time() + KILL_DELAY
+    def _wait(self, timeout=None):
+        # wait up to 'timeout' seconds (forever if None) for the
+        # process to exit; return True if it has
+        if wait_timeout:
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                return False
+            return True
+        if timeout is not None:
+            target = time.time() + timeout
         self.process.poll()
-        while self.process.returncode is None and time.time() < target:
-            self.process.poll()
+        while self.process.returncode is None:
+            if timeout is not None and time.time() >= target:
+                return False
             time.sleep(1)
-        if self.process.returncode is not None:
+            self.process.poll()
+        return True
+
+    def _end(self):
+        if self._wait(KILL_DELAY):
             while self._handle_log(self.process.stderr):
                 pass
             return True
         self._kill()
-        self.process.poll()
-        while self.process.returncode is None:
-            self.process.poll()
-            time.sleep(1)
+        self._wait()
         while self._handle_log(self.process.stderr):
             pass
         return False
@@ -606,15 +821,15 @@ class Sndrcv_base(Daemon):
         return args
 
     def _check_file(self, dir, finfo):
-        (path, (size, ck_sha, ck_md5)) = finfo
+        (path, (size, ck_md5)) = finfo
         path = os.path.join(self.dirname[dir], os.path.basename(path))
-        if not os.path.exists(path):
+        try:
+            nsize = os.path.getsize(path)
+        except OSError:
             return ("Does not exist", path)
-        (nsize, ck2_sha, ck2_md5) = checksum_file(path)
         if nsize != size:
             return ("Size mismatch (%s != %s)" % (size, nsize), path)
-        if ck2_sha != ck_sha:
-            return ("SHA mismatch (%s != %s)" % (ck_sha, ck2_sha), path)
+        ck2_md5 = checksum_only(path)
         if ck2_md5 != ck_md5:
             return ("MD5 mismatch (%s != %s)" % (ck_md5, ck2_md5), path)
         return (None, path)
@@ -651,8 +866,14 @@ class Rwsender(Sndrcv_base):
                                   dir = self.dirname["in"], size = size)
 
     def send_files(self, files):
+        # link the files into the incoming directory when possible;
+        # rwsender only renames and removes them, never rewrites them
         for f, data in files:
-            shutil.copy(f, self.dirname["in"])
+            dest = os.path.join(self.dirname["in"], os.path.basename(f))
+            try:
+                os.link(f, dest)
+            except OSError:
+                shutil.copyfile(f, dest)
 
     def check_error(self, data):
         return self._check_file("error", data)
@@ -748,14 +969,25 @@ class System(Dirobject):
             client.set_ca(self.ca_key, self.ca_cert)
             server.set_ca(self.ca_key, self.ca_cert)
 
+    # Calls that only message daemons that are already running, and so
+    # may be made on all of them at once.  start() forks the daemon's
+    # child and init() may create certificates; those run serially.
+    parallel_calls = frozenset(["stop", "exit"])
+
     def _forall(self, call, which, *args, **kwds):
         if which == "clients":
-            it = self.clients
+            it = list(self.clients)
         elif which == "servers":
-            it = self.servers
+            it = list(self.servers)
         else:
-            it = itertools.chain(self.clients, self.servers)
-        return [getattr(x, call)(*args, **kwds) for x in it]
+            it = list(itertools.chain(self.clients, self.servers))
+        if (ThreadPoolExecutor is None or len(it) < 2
+            or call not in self.parallel_calls):
+            return [getattr(x, call)(*args, **kwds) for x in it]
+        with ThreadPoolExecutor(max_workers=len(it)) as executor:
+            futures = [executor.submit(getattr(x, call), *args, **kwds)
+                       for x in it]
+            return [f.result() for f in futures]
 
     def start(self, which = None):
         self._forall("init", which)
@@ -832,6 +1064,22 @@ class SystemCert(System):
 #def Receiver(**kwds):
 #    return Rwreceiver(overwrite=OVERWRITE, log_level=LOG_LEVEL, **kwds)
 
+@contextlib.contextmanager
+def system_guard(sy):
+    # Run the body of a test that uses the System 'sy'.  If the body
+    # fails, report the traceback with a single write and stop the
+    # daemons; always end them afterwards.
+    try:
+        yield sy
+    except:
+        if sys.exc_info()[0] is KeyboardInterrupt:
+            global_log(False, "%s: Interrupted by C-c" % os.getpid())
+        sys.stderr.write(traceback.format_exc())
+        sy.stop()
+        raise
+    finally:
+        sy.end(noremove=NO_REMOVE)
+
 def _testConnectAndClose(tls=False, hostname="localhost"):
     if tls and not tls_supported():
         return None
@@ -839,7 +1087,7 @@ def _testConnectAndClose(tls=False, hostname="localhost"):
     s1 = Rwsender()
     r1 = Rwreceiver()
     sy = System()
-    try:
+    with system_guard(sy):
         sy.connect(s1, r1, tls=tls, hostname=hostname)
         sy.start()
         check_started([s1], [r1], tls=tls)
@@ -849,12 +1097,6 @@ def _testConnectAndClose(tls=False, hostname="localhost"):
                 (r1, 20, "Finished shutting down"))
         trigger((s1, 25, "Stopped logging"),
                 (r1, 25, "Stopped logging"))
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
 
 def testConnectOnlyIPv4Addr():
     """
@@ -915,7 +1157,7 @@ def _testSendRcv(tls=False,
     s1.create_dirs()
     s1.send_files(rfiles)
     sy = System()
-    try:
+    with system_guard(sy):
         if sender_client:
             cli = s1
             srv = r1
@@ -939,8 +1181,7 @@ def _testSendRcv(tls=False,
         check_connected([cli], [srv], 75)
         try:
             for path, data in rfiles:
-                base = os.path.basename(path)
-                data = {"name": re.escape(base),
+                data = {"name": escaped_names[path],
                         "rname": r1.name, "sname": s1.name}
                 trigger((s1, 40,
                          ("Succeeded sending .*/%(name)s to %(rname)s|"
@@ -960,147 +1201,32 @@ def _testSendRcv(tls=False,
         sy.stop()
         trigger((s1, 25, "Stopped logging"),
                 (r1, 25, "Stopped logging"))
-    except KeyboardInterrupt:
-        global_log(False, "%s: Interrupted by C-c", os.getpid())
-        traceback.print_exc()
-        sy.stop()
-        raise
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
-
-
-def testSendRcvStopReceiverServer():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    stopping the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=False, kill=False)
-
-def testSendRcvStopSenderServer():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    stopping the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=True, kill=False)
 
-def testSendRcvStopReceiverClient():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    stopping the receiver.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=False, kill=False)
 
-def testSendRcvStopSenderClient():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    stopping the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=True, kill=False)
-
-def testSendRcvKillReceiverServer():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    killing the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=False, kill=True)
-
-def testSendRcvKillSenderServer():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    killing the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=True, kill=True)
-
-def testSendRcvKillReceiverClient():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    killing the receiver.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=False, kill=True)
-
-def testSendRcvKillSenderClient():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    killing the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=True, kill=True)
-
-
-def testSendRcvStopReceiverServerTLS():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    stopping the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=False, kill=False, tls=True)
-
-def testSendRcvStopSenderServerTLS():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    stopping the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=True, kill=False, tls=True)
-
-def testSendRcvStopReceiverClientTLS():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    stopping the receiver.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=False, kill=False, tls=True)
-
-def testSendRcvStopSenderClientTLS():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    stopping the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=True, kill=False, tls=True)
-
-def testSendRcvKillReceiverServerTLS():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    killing the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=False, kill=True, tls=True)
-
-def testSendRcvKillSenderServerTLS():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    killing the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=True, kill=True, tls=True)
-
-def testSendRcvKillReceiverClientTLS():
-    """
-    Test a sender/receiver connection, with sender as server,
-    sending files.  Midway the connection is terminated by
-    killing the receiver.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=False, stop_sender=False, kill=True, tls=True)
+def _sendrcv_tests():
+    # The testSendRcv* tests send files between a sender and a
+    # receiver.  Midway the connection is terminated by stopping or
+    # killing one side, which is restarted, and the transfer resumes.
+    # A test's name gives how the connection is terminated (Stop or
+    # Kill), which side is terminated (Sender or Receiver), whether
+    # that side is the Server or the Client, and whether TLS is used.
+    # Map each name to the arguments for _testSendRcv().
+    tests = {}
+    for (kill, stop_sender, sender_client, tls) in itertools.product(
+            (False, True), repeat=4):
+        if stop_sender == sender_client:
+            role = "Client"
+        else:
+            role = "Server"
+        name = "testSendRcv%s%s%s%s" % (("Stop", "Kill")[kill],
+                                        ("Receiver", "Sender")[stop_sender],
+                                        role, ("", "TLS")[tls])
+        tests[name] = {"sender_client": sender_client,
+                       "stop_sender": stop_sender,
+                       "kill": kill, "tls": tls}
+    return tests
 
-def testSendRcvKillSenderClientTLS():
-    """
-    Test a sender/receiver connection, with receiver as server,
-    sending files.  Midway the connection is terminated by
-    killing the sender.  The connection is restarted and resumed.
-    """
-    _testSendRcv(sender_client=True, stop_sender=True, kill=True, tls=True)
+SENDRCV_TESTS = _sendrcv_tests()
 
 
 def _testMultiple(tls=False):
@@ -1113,7 +1239,7 @@ def _testMultiple(tls=False):
     r1 = Rwreceiver()
     r2 = Rwreceiver()
     sy = System()
-    try:
+    with system_guard(sy):
         sy.connect([r1, r2], [s1, s2], tls=tls)
         sy.start()
         check_started([r1, r2], [s1, s2], tls=tls)
@@ -1123,8 +1249,8 @@ def _testMultiple(tls=False):
         fileb = rfiles[1]
         s1.send_files([filea])
         s2.send_files([fileb])
-        params = {"filea": re.escape(os.path.basename(filea[0])),
-                  "fileb": re.escape(os.path.basename(fileb[0])),
+        params = {"filea": escaped_names[filea[0]],
+                  "fileb": escaped_names[fileb[0]],
                   "rnamec": r1.name, "rnamed": r2.name}
 
         trigger((s1, 40,
@@ -1147,12 +1273,6 @@ def _testMultiple(tls=False):
                 (r1, 25, "Stopped logging"),
                 (s2, 25, "Stopped logging"),
                 (r2, 25, "Stopped logging"))
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
 
 def testMultiple():
     """
@@ -1178,25 +1298,32 @@ def _testFilter(tls=False):
     r2 = Rwreceiver()
     s1 = Rwsender(filters=[(r1.name, "[a-g]$"), (r2.name, "[d-j]$")])
     sy = System()
-    try:
+    with system_guard(sy):
         sy.connect([r1, r2], s1, tls=tls)
         sy.start()
         check_started([r1, r2], [s1], tls=tls)
         check_connected([r1, r2], [s1], timeout=70)
 
         s1.send_files(rfiles)
-        cfiles = [x for x in rfiles if 'a' <= x[0][-1] <= 'g']
-        dfiles = [x for x in rfiles if 'd' <= x[0][-1] <= 'j']
-        for (f, data) in cfiles:
-            trigger((s1, 25,
-                     "Succeeded sending .*/%(file)s to %(name)s"
-                     % {"file": re.escape(os.path.basename(f)),
-                        "name" : r1.name}))
-        for (f, data) in dfiles:
-            trigger((s1, 25,
-                     "Succeeded sending .*/%(file)s to %(name)s"
-                     % {"file": re.escape(os.path.basename(f)),
-                        "name" : r2.name}))
+        # Partition the files by which filters they match: bit 0 is
+        # set for r1's filter, bit 1 for r2's
+        groups = [[], [], [], []]
+        for f in rfiles:
+            last = f[0][-1]
+            mask = 0
+            if 'a' <= last <= 'g':
+                mask |= 1
+            if 'd' <= last <= 'j':
+                mask |= 2
+            groups[mask].append(f)
+        cfiles = groups[1] + groups[3]
+        dfiles = groups[2] + groups[3]
+        trigger_names(s1, 25,
+                      "Succeeded sending .*/%%s to %s" % re.escape(r1.name),
+                      [escaped_names[f] for (f, data) in cfiles])
+        trigger_names(s1, 25,
+                      "Succeeded sending .*/%%s to %s" % re.escape(r2.name),
+                      [escaped_names[f] for (f, data) in dfiles])
         for f in cfiles:
             (error, path) = r1.check_sent(f)
             if error:
@@ -1208,15 +1335,13 @@ def _testFilter(tls=False):
             if error:
                 global_log(False, ("Error receiving %s: %s" %
                                    (os.path.basename(f[0]), error)))
-        cset = set(cfiles)
-        dset = set(dfiles)
-        for f in cset - dset:
+        for f in groups[1]:
             (error, path) = r2.check_sent(f)
             if not error:
                 global_log(False, ("Unexpectedly received file %s" %
                                    os.path.basename(f[0])))
                 raise FileTransferError()
-        for f in dset - cset:
+        for f in groups[2]:
             (error, path) = r1.check_sent(f)
             if not error:
                 global_log(False, ("Unexpectedly received file %s" %
@@ -1226,12 +1351,6 @@ def _testFilter(tls=False):
         trigger((s1, 25, "Stopped logging"),
                 (r1, 25, "Stopped logging"),
                 (r2, 25, "Stopped logging"))
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
 
 def testFilter():
     """
@@ -1260,25 +1379,18 @@ def testPostCommand():
     s1.create_dirs()
     s1.send_files(rfiles)
     sy = System()
-    try:
+    with system_guard(sy):
         sy.connect(s1, r1)
         sy.start()
         check_connected([s1], [r1], timeout=70)
-        for path, data in rfiles:
-            trigger((r1, 40,
-                     ("Post command: Ident: %(sname)s  "
-                      "Filename: .*/%(file)s") %
-                     {"file": re.escape(os.path.basename(path)),
-                      "sname": s1.name}), pid=False)
+        trigger_names(r1, 40,
+                      ("Post command: Ident: %s  Filename: .*/%%s"
+                       % re.escape(s1.name)),
+                      [escaped_names[path] for (path, data) in rfiles],
+                      pid=False)
         sy.stop()
         trigger((s1, 25, "Stopped logging"),
                 (r1, 25, "Stopped logging"))
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
 
 
 def _testFailedConnection(ca_cert, key, cert, hostname="127.0.0.1"):
@@ -1290,7 +1402,7 @@ def _testFailedConnection(ca_cert, key, cert, hostname="127.0.0.1"):
     s1 = RwsenderCert(None, ca_cert, key, cert)
     r1 = RwreceiverCert(None, ca_cert, key, cert)
     sy = SystemCert()
-    try:
+    with system_guard(sy):
         sy.connect(s1, r1, tls=True, hostname=hostname)
         sy.start()
         check_started([s1], [r1], tls=True)
@@ -1301,12 +1413,6 @@ def _testFailedConnection(ca_cert, key, cert, hostname="127.0.0.1"):
                 (r1, 20, "Finished shutting down"))
         trigger((s1, 25, "Stopped logging"),
                 (r1, 25, "Stopped logging"))
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
 
 def testExpiredAuthorityTLS():
     """
@@ -1337,7 +1443,7 @@ def testMismatchedCertsTLS():
         key=os.path.join(srcdir, "tests", "other-key.pem"),
         cert=os.path.join(srcdir, "tests", "other-cert.pem"))
     sy = SystemCert()
-    try:
+    with system_guard(sy):
         sy.connect(r1, s1, tls=True, hostname=hostname)
         sy.start()
         check_started([r1], [s1], tls=True)
@@ -1348,12 +1454,6 @@ def testMismatchedCertsTLS():
                 (r1, 20, "Finished shutting down"))
         trigger((s1, 25, "Stopped logging"),
                 (r1, 25, "Stopped logging"))
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
 
 def testOtherCertsTLS():
     hostname = "127.0.0.1"
@@ -1368,7 +1468,7 @@ def testOtherCertsTLS():
         key=os.path.join(srcdir, "tests", "other-key.pem"),
         cert=os.path.join(srcdir, "tests", "other-cert.pem"))
     sy = SystemCert()
-    try:
+    with system_guard(sy):
         sy.connect(r1, s1, tls=True, hostname=hostname)
         sy.start()
         check_started([r1], [s1], tls=True)
@@ -1378,12 +1478,19 @@ def testOtherCertsTLS():
                 (r1, 20, "Finished shutting down"))
         trigger((s1, 25, "Stopped logging"),
                 (r1, 25, "Stopped logging"))
-    except:
-        traceback.print_exc()
-        sy.stop()
-        raise
-    finally:
-        sy.end(noremove=NO_REMOVE)
+
+
+# map each test name to the function that runs it
+TESTS_BY_NAME = dict((name, fn) for (name, fn) in globals().items()
+                     if name.startswith("test") and callable(fn))
+TESTS_BY_NAME.update((name, functools.partial(_testSendRcv, **params))
+                     for (name, params) in SENDRCV_TESTS.items())
+
+def print_test_names():
+    # the default tests in the order they are run, then the others
+    others = sorted(set(TESTS_BY_NAME) - set(ALL_TESTS))
+    for name in ALL_TESTS + others:
+        print(name)
 
 
 if __name__ == '__main__':
@@ -1435,7 +1542,7 @@ if __name__ == '__main__':
 
     try:
         for x in args:
-            locals()[x]()
+            TESTS_BY_NAME[x]()
     except SystemExit:
         raise
     finally:
@@ -11,12 +11,14 @@
 # $SiLK: daemon_test.py ef14e54179be 2020-04-14 21:57:45Z mthomas $
 #######################################################################
 from __future__ import print_function
+import errno
 import numbers
 import os
 import os.path
 import select
 import shutil
 import signal
+import stat
 import socket
 import struct
 import subprocess
@@ -29,20 +31,25 @@ from config_vars import config_vars
 
 
 #V5PDU_LEN  = 1464
-TCPBUF     = 2048
-LINEBUF    = 1024
+TCPBUF     = 65536
+SENDFILEBUF = 1048576
+LINEBUF    = 65536
+
+# Descriptors are not inherited by default since Python 3.4 (PEP 446),
+# so only close them in the child on older versions; leaving close_fds
+# off lets subprocess use posix_spawn() where it can
+close_fds = sys.version_info < (3, 4)
 
 if sys.version_info[0] >= 3:
-    coding = {"encoding": "latin_1"}
+    def string_write(f, s):
+        return f.write(s.encode("latin_1"))
 else:
-    coding = {}
-
-def string_write(f, s):
-    return f.write(bytes(s, **coding))
+    def string_write(f, s):
+        return f.write(bytes(s))
 
 class TimedReadline(object):
     def __init__(self, fd):
-        self.buf = ""
+        self.buf = bytearray()
         if isinstance(fd, numbers.Integral):
             self.fd = fd
         else:
@@ -50,16 +57,16 @@ class TimedReadline(object):
 
     def __call__(self, timeout):
         while True:
-            x = self.buf.find('\n')
+            x = self.buf.find(b'\n')
             if x >= 0:
-                retval = self.buf[:x+1]
-                self.buf = self.buf[x+1:]
+                retval = self.buf[:x+1].decode('latin_1')
+                del self.buf[:x+1]
                 return retval
             (r, w, x) = select.select([self.fd], [], [], timeout)
             if r:
                 more = os.read(self.fd, LINEBUF)
                 if more:
-                    self.buf += more.decode('latin_1')
+                    self.buf.extend(more)
                 else:
                     return None
             else:
@@ -90,14 +97,18 @@ class Dirobject(object):
         if not self.dirs_created:
             self.create_basedir()
             for name in self.dirs:
-                self.dirname[name] = os.path.abspath(
-                    os.path.join(self.basedir, name))
-                if os.path.exists(self.dirname[name]):
+                path = os.path.abspath(os.path.join(self.basedir, name))
+                self.dirname[name] = path
+                # try the mkdir rather than checking for the directory
+                # first; the common case is that it does not exist
+                try:
+                    os.mkdir(path)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
                     if self.overwrite:
-                        shutil.rmtree(self.dirname[name])
-                        os.mkdir(self.dirname[name])
-                else:
-                    os.mkdir(self.dirname[name])
+                        shutil.rmtree(path)
+                        os.mkdir(path)
             self.dirs_created = True
 
     def get_path(self, name, path):
@@ -118,7 +129,7 @@ class PduSender(object):
                 "--pdu-network", self._address + ":" + str(self._port),
                 "--max-records", str(self._max_recs)]
         self._log("Starting: %s" % args)
-        self.process = subprocess.Popen(args)
+        self.process = subprocess.Popen(args, close_fds=close_fds)
         return self.process
 
     def stop(self):
@@ -140,6 +151,9 @@ class TcpSender(object):
         self._log = log
         self._address = address
         self._running = False
+        # while go() runs, stop() writes to this socket to wake it
+        # from select()
+        self._wake_w = None
 
     def start(self):
         thread = threading.Thread(target = self.go)
@@ -148,6 +162,16 @@ class TcpSender(object):
 
     def go(self):
         self._running = True
+        (wake_r, self._wake_w) = socket.socketpair()
+        try:
+            self._send(wake_r)
+        finally:
+            wake_w = self._wake_w
+            self._wake_w = None
+            wake_r.close()
+            wake_w.close()
+
+    def _send(self, wake_r):
         sock = None
         # Try each address until we connect to one; no need to report
         # errors here
@@ -171,34 +195,74 @@ class TcpSender(object):
                       (self._address, self._port))
             sys.exit(1)
         self._log("Connected to [%s]:%d" % (self._address, self._port))
-        sock.settimeout(1)
-        # Send the data
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        wake = [wake_r]
+        socks = [sock]
+        # Send the data.  When the source is a regular file, have the
+        # kernel copy it to the socket; otherwise read each chunk and
+        # advance a view over it on a short send rather than copying
+        # what remains.
+        fd = self._sendfile_fd()
+        if fd is not None:
+            offset = self._file.tell()
+        pdu = memoryview(b"")
         while self._running:
-            pdu = self._file.read(TCPBUF)
-            if not pdu:
+            if fd is None and not len(pdu):
+                pdu = memoryview(self._file.read(TCPBUF))
+                if not len(pdu):
+                    self._running = False
+                    continue
+            # Wait for the socket to be writable or for stop() to wake us
+            (readers, writers, x) = select.select(wake, socks, [])
+            if readers:
                 self._running = False
                 continue
-            count = len(pdu)
-            while self._running and count:
-                try:
+            try:
+                if fd is None:
                     num_sent = sock.send(pdu)
                     pdu = pdu[num_sent:]
-                    count -= num_sent
-                except socket.timeout:
-                    pass
-                except socket.error as msg:
-                    if isinstance(msg, tuple):
-                        errmsg = msg[1]
-                    else:
-                        errmsg = msg
-                    self._log("Error sending to [%s]:%d: %s" %
-                              (self._address, self._port, errmsg))
-                    self._running = False
+                else:
+                    num_sent = os.sendfile(sock.fileno(), fd, offset,
+                                           SENDFILEBUF)
+                    if not num_sent:
+                        self._running = False
+                    offset += num_sent
+            except (socket.error, OSError) as msg:
+                if getattr(msg, "errno", None) in (errno.EAGAIN,
+                                                   errno.EWOULDBLOCK):
+                    continue
+                if isinstance(msg, tuple):
+                    errmsg = msg[1]
+                else:
+                    errmsg = msg
+                self._log("Error sending to [%s]:%d: %s" %
+                          (self._address, self._port, errmsg))
+                self._running = False
         # Done
         sock.close()
 
+    def _sendfile_fd(self):
+        # Return the descriptor of the file to send if os.sendfile()
+        # can send from it, or None
+        if not hasattr(os, "sendfile"):
+            return None
+        try:
+            fd = self._file.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                return fd
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+        return None
+
     def stop(self):
         self._running = False
+        wake_w = self._wake_w
+        if wake_w is not None:
+            try:
+                wake_w.send(b"x")
+            except socket.error:
+                pass
 
 
 class UdpSender(object):
@@ -241,8 +305,14 @@ class UdpSender(object):
                       (self._address, self._port))
             sys.exit(1)
         self._log("Connected to [%s]:%d" % (self._address, self._port))
-        # seconds to sleep after sending a packet
+        # seconds to allow for each packet sent; rather than sleeping
+        # after each packet, sleep once per batch of packets until
+        # the time allowed for the batch has passed
         sleeptime = 0.000200
+        batchsize = 16
+        batchcount = 0
+        clock = getattr(time, "monotonic", time.time)
+        next_tx = clock()
         # the loopback MTU
         MTU = 4096
         # mapping from Template IDs to lengths
@@ -266,10 +336,12 @@ class UdpSender(object):
         # parsing an IPFIX set header
         setstruct = struct.Struct("!HH")
         setlen = setstruct.size
-        # to update the sequence number in a header
-        seqnumstruct = struct.Struct("!I")
         # number of records, for handling sequence number
         reccount = 0
+        # the header of each outgoing message is packed into this
+        # buffer and sent along with a view of the set, avoiding copies
+        hdrbuf = bytearray(hdrlen)
+        gather = hasattr(sock, "sendmsg")
         while self._running:
             hdr = self._file.read(hdrlen)
             if len(hdr) != hdrlen:
@@ -289,35 +361,43 @@ class UdpSender(object):
                           (octets - hdrlen, len(msg)))
                 self._running = False
                 continue
-            while self._running and len(msg) > setlen:
+            # walk the sets in the message with an offset into a view
+            view = memoryview(msg)
+            off = 0
+            end = len(msg)
+            while self._running and end - off > setlen:
                 # get next set from the message
-                (id, sz) = setstruct.unpack(msg[0:setlen])
+                (id, sz) = setstruct.unpack_from(msg, off)
                 #|self._log("Got set id=%d, sz=%d, remaing msg = %d" %
-                #|          (id, sz, len(msg) - sz))
+                #|          (id, sz, end - off - sz))
                 if sz < setlen:
                     self._log("Bad set length %d, id was %d" % (sz, id))
-                    msg = ""
+                    off = end
                     continue
-                setdata = msg[0:sz]
-                msg = msg[sz:]
+                setdata = view[off:off + sz]
+                off += sz
                 # build the new single-set message
                 mysize = hdrlen + sz
                 if mysize > MTU:
                     self._log("Not sending large packet (%d octets)" % mysize)
                     continue
-                hdr = hdrstruct.pack(vers, mysize, exptime, reccount, domain)
+                hdrstruct.pack_into(hdrbuf, 0,
+                                    vers, mysize, exptime, reccount, domain)
                 #|self._log("Sending msg ver=%d, oct=%d, tim=%d, cnt=%d, dom=%d"
                 #|          % (vers, mysize, exptime, reccount, domain))
                 # update record count
                 if id >= 256:
-                    try:
-                        reclen = tidtolength[id]
-                        reccount = reccount + int((sz - setlen) / reclen)
-                    except KeyError:
+                    reclen = tidtolength.get(id)
+                    if reclen:
+                        reccount += (sz - setlen) // reclen
+                    else:
                         self._log("Set uses unknown id %d" % id)
                 # send it
                 try:
-                    sock.send(hdr + setdata)
+                    if gather:
+                        sock.sendmsg([hdrbuf, setdata])
+                    else:
+                        sock.send(bytes(hdrbuf) + setdata.tobytes())
                 except socket.error as err:
                     if isinstance(err, tuple):
                         errmsg = err[1]
@@ -325,7 +405,17 @@ class UdpSender(object):
                         errmsg = err
                     self._log("Error sending to [%s]:%d: %s" %
                               (self._address, self._port, errmsg))
-                time.sleep(sleeptime)
+                next_tx += sleeptime
+                batchcount += 1
+                if batchcount == batchsize:
+                    batchcount = 0
+                    delay = next_tx - clock()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        # fell behind; do not try to catch up with a
+                        # burst of packets
+                        next_tx = clock()
             #|self._log("At end of message, count = %d, reccount = %d" %
             #|          (count, reccount))
         # Done
@@ -335,9 +425,35 @@ class UdpSender(object):
         self._running = False
 
 
-def get_ephemeral_port():
+# Sockets bound to ports that get_ephemeral_port() has reserved.  A
+# port stays bound until it is handed out, so the kernel cannot give it
+# to another process (such as a concurrently running test) in the
+# meantime.  The pool is only used where forked children can drop
+# their copies of the sockets; otherwise a child would keep a port
+# bound after the parent handed it out.
+PORT_POOL_SIZE = 8
+port_pool = []
+
+def close_port_pool():
+    while port_pool:
+        port_pool.pop().close()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=close_port_pool)
+
+def bind_ephemeral_port():
     sock = socket.socket()
     sock.bind(("", 0))
+    return sock
+
+def get_ephemeral_port():
+    if not port_pool and hasattr(os, "register_at_fork"):
+        port_pool.extend(bind_ephemeral_port()
+                         for x in range(PORT_POOL_SIZE))
+    if port_pool:
+        sock = port_pool.pop()
+    else:
+        sock = bind_ephemeral_port()
     (addr, port) = sock.getsockname()
     sock.close()
     return port
@@ -2,25 +2,30 @@
 
 import sys,struct,os,silk
 
+# packed forms of the plugin's binary values
+net_u16 = struct.Struct("!H")
+native_u32 = struct.Struct("I")
+
 # FILTERING
 #
 # passes records that have the same sport and dport. when finished,
 # prints to stderr the number of unique same-port combinations it saw
 
-saw_port = {}
+# one flag per port number
+saw_port = bytearray(65536)
 unique_ports = 0
 
 def filter_same_port(r):
-    global saw_port, unique_ports
-    if r.sport != r.dport:
+    global unique_ports
+    sport = r.sport
+    if sport != r.dport:
         return False
-    if r.sport not in saw_port:
+    if not saw_port[sport]:
         unique_ports += 1
-        saw_port[r.sport] = 1
+        saw_port[sport] = 1
     return True
 
 def finalize_same_port():
-    global unique_ports
     sys.stderr.write("Saw %d same-port combinations\n" % unique_ports)
 
 register_filter(filter_same_port, finalize=finalize_same_port)
@@ -32,19 +37,23 @@ register_filter(filter_same_port, finalize=finalize_same_port)
 # would be the service port.
 
 def lower_port_rec_to_text(r):
-    if r.sport < r.dport:
-        return "%d" % r.sport
-    return "%d" % r.dport
+    sport = r.sport
+    dport = r.dport
+    if sport < dport:
+        return str(sport)
+    return str(dport)
 
 def lower_port_rec_to_bin(r):
-    if r.sport < r.dport:
-        return struct.pack("!H", r.sport)
-    return struct.pack("!H", r.dport)
+    sport = r.sport
+    dport = r.dport
+    if sport < dport:
+        return net_u16.pack(sport)
+    return net_u16.pack(dport)
 
 def lower_port_bin_to_text(b):
-    return "%d" % struct.unpack("!H", b)
+    return str(net_u16.unpack(b)[0])
 
-register_field('lower_port', column_width=5, bin_bytes = struct.calcsize("!H"),
+register_field('lower_port', column_width=5, bin_bytes = net_u16.size,
                bin_to_text = lower_port_bin_to_text,
                rec_to_bin = lower_port_rec_to_bin,
                rec_to_text = lower_port_rec_to_text)
@@ -56,21 +65,21 @@ register_field('lower_port', column_width=5, bin_bytes = struct.calcsize("!H"),
 # bin
 
 def max_bytes_check(r, packed_max):
-    (max_bytes,) = struct.unpack("I", packed_max)
+    (max_bytes,) = native_u32.unpack(packed_max)
     if r.bytes > max_bytes:
-        packed_max = struct.pack("I", r.bytes)
+        packed_max = native_u32.pack(r.bytes)
     return packed_max
 
 def max_bytes_merge(packed_max1, packed_max2):
-    (max_bytes1,) = struct.unpack("I", packed_max1)
-    (max_bytes2,) = struct.unpack("I", packed_max2)
+    (max_bytes1,) = native_u32.unpack(packed_max1)
+    (max_bytes2,) = native_u32.unpack(packed_max2)
     if max_bytes1 > max_bytes2:
         return max_bytes1
     return max_bytes2
 
 def max_bytes_compare(packed_max1, packed_max2):
-    (max_bytes1,) = struct.unpack("I", packed_max1)
-    (max_bytes2,) = struct.unpack("I", packed_max2)
+    (max_bytes1,) = native_u32.unpack(packed_max1)
+    (max_bytes2,) = native_u32.unpack(packed_max2)
     if max_bytes1 > max_bytes2:
         return 1
     if max_bytes1 < max_bytes2:
@@ -78,13 +87,13 @@ def max_bytes_compare(packed_max1, packed_max2):
     return 0
 
 def max_bytes_print(packed_max):
-    (max_bytes,) = struct.unpack("I", packed_max)
-    return "%d" % max_bytes
+    (max_bytes,) = native_u32.unpack(packed_max)
+    return str(max_bytes)
 
-register_field("max_bytes", column_width = 10, bin_bytes = struct.calcsize("I"),
+register_field("max_bytes", column_width = 10, bin_bytes = native_u32.size,
                add_rec_to_bin = max_bytes_check, bin_to_text = max_bytes_print,
                bin_merge = max_bytes_merge, bin_compare = max_bytes_compare,
-               initial_value = struct.pack("I", 0))
+               initial_value = native_u32.pack(0))
 
 
 # SIMPLIFIED FIELD REGISTRATION
@@ -106,7 +115,11 @@ if silk.ipv6_enabled():
 # presumably this would be the service port.
 
 def lower_port_simple(r):
-    return min(r.sport, r.dport)
+    sport = r.sport
+    dport = r.dport
+    if sport < dport:
+        return sport
+    return dport
 
 register_int_field("lower_port_simple", lower_port_simple, 0, 0xffff)
 
@@ -117,8 +130,11 @@ protocols = {6: 'TCP', 17: 'UDP',  1: 'ICMP'}
 sorted_proto = list(protocols.values())
 sorted_proto.sort()
 
+# the name of every protocol number, built once
+proto_names = tuple(protocols.get(i, str(i)) for i in range(256))
+
 def proto_name(r):
-    return protocols.get(r.protocol, str(r.protocol))
+    return proto_names[r.protocol]
 
 register_enum_field("proto_name", proto_name, 4, sorted_proto)
 
@@ -127,7 +143,8 @@ register_enum_field("proto_name", proto_name, 4, sorted_proto)
 #
 
 def large_packet_aggregator(r):
-    if r.bytes // r.packets > 1000:
+    # same as r.bytes // r.packets > 1000, without the division
+    if r.bytes >= 1001 * r.packets:
         return 1
     return 0
 
@@ -137,19 +154,43 @@ register_int_sum_aggregator("large_packet_flows", large_packet_aggregator)
 # 'smallest_packets' is the smallest average packet size
 
 def avg_packet(r):
-    return int(r.bytes // r.packets)
+    return r.bytes // r.packets
 
 register_int_max_aggregator("largest_packets", avg_packet)
 register_int_min_aggregator("smallest_packets", avg_packet)
 
 
 # Country Code
+#
+# flows tend to repeat addresses, so remember the country code of each
+# address looked up; start over when the cache is full
+
+country_codes = {}
+country_codes_max = 65536
+
+# marks an address not yet looked up, since an address without a
+# country code is cached as None
+_MISSING = object()
+
+def country_code(addr):
+    cc = country_codes.get(addr, _MISSING)
+    if cc is _MISSING:
+        if len(country_codes) >= country_codes_max:
+            country_codes.clear()
+        cc = country_codes[addr] = addr.country_code()
+    return cc
+
+def sip_country_code(rec):
+    return country_code(rec.sip)
+
+def dip_country_code(rec):
+    return country_code(rec.dip)
 
 if os.getenv("SILK_COUNTRY_CODES"):
     try:
         silk.init_country_codes()
-        register_enum_field("py-scc", lambda rec: rec.sip.country_code(), 6)
-        register_enum_field("py-dcc", lambda rec: rec.dip.country_code(), 6)
-    except:
+        register_enum_field("py-scc", sip_country_code, 6)
+        register_enum_field("py-dcc", dip_country_code, 6)
+    except Exception:
         if os.getenv("SILK_PYTHON_TRACEBACK"):
             raise